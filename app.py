@@ -1,31 +1,79 @@
 # main.py
 
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
+from pydantic import BaseModel, ConfigDict, Field
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime
-import base64
+import asyncio
+import binascii
 import httpx
+import logging
+import orjson
 import os
+import time
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
 import firebase_admin
 from firebase_admin import credentials, firestore
-from twilio.rest import Client
+from google.api_core.exceptions import InvalidArgument
+from google.cloud.exceptions import NotFound
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI()
+# uvicorn only configures its own loggers, so give ours a handler
+logger = logging.getLogger("daraja")
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.http = _new_http_client()
+
+    # Initialize Firebase once per worker process
+    app.state.db = _init_firestore()
+
+    # Open the Firestore gRPC channel before the first donation arrives; a single
+    # short attempt so an unreachable Firestore doesn't hold up startup
+    warmup = app.state.db.collection('_warmup').document('x').get
+    try:
+        await asyncio.to_thread(warmup, retry=None, timeout=_WARMUP_TIMEOUT)
+    except Exception as e:
+        logger.warning("Firestore warmup failed: %s", e)
+
+    # Background task that batches pending donation writes
+    app.state.flusher_stop = asyncio.Event()
+    app.state.flusher = asyncio.create_task(_flusher(app.state.db, app.state.flusher_stop))
+    yield
+    app.state.flusher_stop.set()
+    await app.state.flusher
+    if _pending:
+        logger.error("Shutting down with %d unsaved pending donations", len(_pending))
+    await app.state.http.aclose()
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+
+# Enable CORS for the donation frontend (comma-separated list in CORS_ORIGINS)
+CORS_ORIGINS = os.getenv("CORS_ORIGINS", "https://jogoocbo.org")
 
-# Enable CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=[origin.strip() for origin in CORS_ORIGINS.split(",") if origin.strip()],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
+# Compress larger JSON responses (e.g. STK push results)
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 # Safaricom Daraja Credentials
 CONSUMER_KEY = os.getenv("CONSUMER_KEY")
 CONSUMER_SECRET = os.getenv("CONSUMER_SECRET")
@@ -33,33 +81,201 @@ PASSKEY = os.getenv("PASSKEY")
 SHORTCODE = os.getenv("SHORTCODE")
 CALLBACK_URL = os.getenv("CALLBACK_URL")
 
+# STK password prefix, constant for the life of the process
+_PREFIX_BYTES = ((SHORTCODE or "") + (PASSKEY or "")).encode('ascii')
+
+# STK Push fields that are the same for every donation
+_PAYLOAD_TEMPLATE = {
+    "BusinessShortCode": SHORTCODE,
+    "TransactionType": "CustomerPayBillOnline",
+    "PartyB": SHORTCODE,
+    "CallBackURL": CALLBACK_URL,
+    "AccountReference": "JogooCBO",
+}
+
+_AUTH = httpx.BasicAuth(CONSUMER_KEY or "", CONSUMER_SECRET or "")
+
 # Twilio Credentials
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
 TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
 
+# Twilio REST endpoint, called through the shared httpx client
+TWILIO_MESSAGES_URL = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json"
+_TWILIO_AUTH = httpx.BasicAuth(TWILIO_ACCOUNT_SID or "", TWILIO_AUTH_TOKEN or "")
+
 # Firebase Credentials
 FIREBASE_KEY_FILE = os.getenv("FIREBASE_KEY_FILE")
-
-# Initialize Firebase
-cred = credentials.Certificate(FIREBASE_KEY_FILE)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-
-# Initialize Twilio
-twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+_WARMUP_TIMEOUT = 5.0
+
+def _init_firestore():
+    # The Firestore client honours FIRESTORE_EMULATOR_HOST for local development
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.Certificate(FIREBASE_KEY_FILE))
+    return firestore.client()
+
+def _new_http_client():
+    # Shared HTTP/2 client so Safaricom and Twilio calls multiplex over pooled connections
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+        headers={"User-Agent": "JogooCBO/1.0"},
+    )
+
+# The lifespan sets these up; serverless runtimes that skip lifespan events
+# (e.g. Vercel) create them on first use instead
+def _get_db(app):
+    db = getattr(app.state, "db", None)
+    if db is None:
+        db = app.state.db = _init_firestore()
+    return db
+
+def _get_http(app):
+    http = getattr(app.state, "http", None)
+    if http is None:
+        http = app.state.http = _new_http_client()
+    return http
+
+# Pending donation writes, committed together by _flusher(). _queued maps each
+# checkout_request_id to its record until the record is committed, so a callback
+# that arrives first can merge the payment into it.
+_pending = []
+_queued = {}
+_FLUSH_INTERVAL = 0.025
+_MAX_FLUSH_BACKOFF = 5.0
+_MAX_BATCH = 450  # Firestore allows at most 500 writes per batch
+_MAX_PENDING = 5_000  # beyond this /donate writes directly instead of queueing
+
+# Errors caused by the records themselves (oversized document or request, bad
+# values). Retrying the same batch would fail forever, so it is split instead.
+_RECORD_ERRORS = (InvalidArgument, ValueError, TypeError)
+
+async def _commit_batch(db, drained):
+    try:
+        batch = db.batch()
+        snapshots = []
+        for doc_ref, donation_record in drained:
+            snapshot = dict(donation_record)
+            snapshots.append(snapshot)
+            batch.set(doc_ref, snapshot)
+        await asyncio.to_thread(batch.commit)
+    except _RECORD_ERRORS as e:
+        if len(drained) == 1:
+            _queued.pop(drained[0][0].id, None)
+            logger.error("Dropping donation id=%s rejected by Firestore: %s", drained[0][0].id, e)
+            return
+        # Halve the batch until the offending records are isolated
+        mid = len(drained) // 2
+        await _commit_batch(db, drained[:mid])
+        await _commit_batch(db, drained[mid:])
+        return
+
+    for (doc_ref, donation_record), snapshot in zip(drained, snapshots):
+        if donation_record != snapshot:
+            # A callback merged the payment in while this commit was in flight
+            _pending.append((doc_ref, donation_record))
+        else:
+            _queued.pop(doc_ref.id, None)
+
+async def _flush_pending(db):
+    # Returns False if a commit failed for a transient reason; those records are
+    # put back in front of the queue so they are retried on the next pass
+    while _pending:
+        drained = _pending[:_MAX_BATCH]
+        del _pending[:_MAX_BATCH]
+        try:
+            await _commit_batch(db, drained)
+        except asyncio.CancelledError:
+            _pending[:0] = [entry for entry in drained if entry[0].id in _queued]
+            raise
+        except Exception as e:
+            # Records committed by an earlier half of a split batch are already done
+            _pending[:0] = [entry for entry in drained if entry[0].id in _queued]
+            logger.error("Failed to save %d pending donations, will retry: %s", len(drained), e)
+            return False
+    return True
+
+async def _flusher(db, stop):
+    # Runs until stop is set, then makes one last pass; stopping this way never
+    # interrupts a commit that is in flight
+    delay = _FLUSH_INTERVAL
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        if await _flush_pending(db):
+            delay = _FLUSH_INTERVAL
+        else:
+            delay = min(delay * 2, _MAX_FLUSH_BACKOFF)
 
 # Daraja API URLs
 ACCESS_TOKEN_URL = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
 STK_PUSH_URL = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
 
+# Cached Safaricom access token (tokens are valid for ~1 hour)
+_token_cache = {"value": None, "exp": 0.0}
+_token_lock = asyncio.Lock()
+
+async def get_access_token(client):
+    if _token_cache["value"] and time.time() < _token_cache["exp"] - 30:
+        return _token_cache["value"]
+
+    async with _token_lock:
+        # Another request may have refreshed the token while we waited
+        if _token_cache["value"] and time.time() < _token_cache["exp"] - 30:
+            return _token_cache["value"]
+
+        token_resp = await client.get(ACCESS_TOKEN_URL, auth=_AUTH)
+        if token_resp.status_code != 200:
+            raise HTTPException(status_code=500, detail="Failed to authenticate with Safaricom")
+
+        token_data = orjson.loads(token_resp.content)
+        _token_cache["value"] = token_data.get("access_token")
+        _token_cache["exp"] = time.time() + int(token_data.get("expires_in", 3599))
+        return _token_cache["value"]
+
+def _token_rejected(resp):
+    # Daraja answers a revoked or expired token with 401, or 404 and errorCode 404.001.03
+    if resp.status_code == 401:
+        return True
+    if resp.status_code == 404:
+        try:
+            return orjson.loads(resp.content).get("errorCode") == "404.001.03"
+        except (orjson.JSONDecodeError, AttributeError):
+            return False
+    return False
+
+# Recently processed callbacks, so Safaricom retries don't repeat the update and SMS.
+# Per-process only; multi-worker deployments would need a shared store (e.g. Redis).
+_seen_callbacks = OrderedDict()
+_SEEN_MAX = 10_000
+
 # Pydantic Model
 class DonationRequest(BaseModel):
-    name: str
-    phone: str
-    amount: int
-    email: str = None
-    message: str = ""
+    model_config = ConfigDict(str_strip_whitespace=True, extra='forbid')
+
+    name: str = Field(min_length=1, max_length=60)
+    phone: str = Field(pattern=r'^[17]\d{8}$')  # Safaricom number without the 254 prefix
+    amount: int = Field(gt=0, lt=1_000_000)
+    email: str | None = Field(default=None, max_length=254)
+    message: str = Field(default="", max_length=500)
+
+async def _send_sms(client, amount, phone, receipt):
+    # Runs after the response is sent, reusing the pooled HTTP client
+    try:
+        sms_resp = await client.post(TWILIO_MESSAGES_URL, auth=_TWILIO_AUTH, data={
+            "Body": f"Thank you for donating KES {amount} to Jogoo CBO! Receipt: {receipt}.",
+            "From": TWILIO_PHONE_NUMBER,
+            "To": f"+{phone}"
+        })
+        sms_resp.raise_for_status()
+        logger.info("sms_sent receipt=%s", receipt)
+    except Exception as e:
+        logger.error("sms_failed receipt=%s error=%s", receipt, e)
 
 # Routes
 
@@ -68,34 +284,26 @@ async def root():
     return {"message": "Welcome to Jogoo CBO M-Pesa Donation API"}
 
 @app.post("/donate")
-async def donate(data: DonationRequest):
-    # Step 1: Get Safaricom Access Token
-    async with httpx.AsyncClient() as client:
-        auth = (CONSUMER_KEY, CONSUMER_SECRET)
-        token_resp = await client.get(ACCESS_TOKEN_URL, auth=auth)
-    
-    if token_resp.status_code != 200:
-        raise HTTPException(status_code=500, detail="Failed to authenticate with Safaricom")
+async def donate(data: DonationRequest, request: Request):
+    client = _get_http(request.app)
 
-    access_token = token_resp.json().get("access_token")
+    # Step 1: Get Safaricom Access Token
+    access_token = await get_access_token(client)
 
     # Step 2: Generate STK Push Password
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    password_str = SHORTCODE + PASSKEY + timestamp
-    password = base64.b64encode(password_str.encode()).decode()
+    gm = time.gmtime()
+    timestamp = f"{gm.tm_year:04d}{gm.tm_mon:02d}{gm.tm_mday:02d}{gm.tm_hour:02d}{gm.tm_min:02d}{gm.tm_sec:02d}"
+    password = binascii.b2a_base64(_PREFIX_BYTES + timestamp.encode('ascii'), newline=False).decode('ascii')
 
     # Step 3: Prepare STK Push payload
+    party = "254" + data.phone
     payload = {
-        "BusinessShortCode": SHORTCODE,
+        **_PAYLOAD_TEMPLATE,
         "Password": password,
         "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
         "Amount": data.amount,
-        "PartyA": f"254{data.phone}",
-        "PartyB": SHORTCODE,
-        "PhoneNumber": f"254{data.phone}",
-        "CallBackURL": CALLBACK_URL,
-        "AccountReference": "JogooCBO",
+        "PartyA": party,
+        "PhoneNumber": party,
         "TransactionDesc": f"Donation from {data.name}"
     }
 
@@ -105,20 +313,28 @@ async def donate(data: DonationRequest):
     }
 
     # Step 4: Initiate STK Push
-    async with httpx.AsyncClient() as client:
+    stk_resp = await client.post(STK_PUSH_URL, headers=headers, json=payload)
+
+    if _token_rejected(stk_resp):
+        # Cached token was revoked early; drop it (unless another request already
+        # replaced it) and retry once with a fresh one
+        if _token_cache["value"] == access_token:
+            _token_cache["exp"] = 0.0
+        access_token = await get_access_token(client)
+        headers["Authorization"] = f"Bearer {access_token}"
         stk_resp = await client.post(STK_PUSH_URL, headers=headers, json=payload)
 
     if stk_resp.status_code != 200:
         raise HTTPException(status_code=500, detail=f"Safaricom STK Push failed: {stk_resp.text}")
 
-    stk_data = stk_resp.json()
+    stk_data = orjson.loads(stk_resp.content)
     checkout_request_id = stk_data.get("CheckoutRequestID")
 
     # Step 5: Save Pending Donation Record
     if checkout_request_id:
         donation_record = {
             "name": data.name,
-            "phone": f"254{data.phone}",
+            "phone": party,
             "amount": data.amount,
             "email": data.email,
             "message": data.message,
@@ -126,59 +342,87 @@ async def donate(data: DonationRequest):
             "checkout_request_id": checkout_request_id,
             "created_at": datetime.utcnow().isoformat()
         }
-        db.collection('donations').add(donation_record)
+        # Keyed by checkout_request_id so the callback can update it directly and
+        # written in the next batch commit. Building the reference here rejects
+        # invalid IDs before they reach the queue.
+        doc_ref = _get_db(request.app).collection('donations').document(checkout_request_id)
+        flusher = getattr(request.app.state, "flusher", None)
+        if flusher is not None and not flusher.done() and len(_pending) < _MAX_PENDING:
+            _pending.append((doc_ref, donation_record))
+            _queued[checkout_request_id] = donation_record
+        else:
+            # No flusher (lifespan did not run) or the queue is backed up; write directly
+            await asyncio.to_thread(doc_ref.set, donation_record)
 
     return stk_data
 
 @app.post("/mpesa-callback")
-async def mpesa_callback(request: Request):
-    body = await request.json()
-    print("M-Pesa Callback Received:", body)
+async def mpesa_callback(request: Request, background_tasks: BackgroundTasks):
+    body = orjson.loads(await request.body())
 
     stk_callback = body.get('Body', {}).get('stkCallback', {})
+    result_code = stk_callback.get('ResultCode')
+    logger.info("callback id=%s rc=%s", stk_callback.get("CheckoutRequestID"), result_code)
 
-    if stk_callback.get('ResultCode') != 0:
-        print("Payment failed or cancelled by user.")
+    if result_code != 0:
         return {"message": "Payment failed or cancelled"}
 
     callback_metadata = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-    mpesa_data = {item['Name']: item.get('Value') for item in callback_metadata}
+    amount = receipt = txn_date = phone = None
+    for item in callback_metadata:
+        name = item['Name']
+        if name == 'Amount':
+            amount = item.get('Value')
+        elif name == 'MpesaReceiptNumber':
+            receipt = item.get('Value')
+        elif name == 'TransactionDate':
+            txn_date = item.get('Value')
+        elif name == 'PhoneNumber':
+            phone = item.get('Value')
 
     checkout_request_id = stk_callback.get("CheckoutRequestID")
 
-    if not mpesa_data or not checkout_request_id:
+    if not callback_metadata or not checkout_request_id:
         return {"message": "Missing payment metadata"}
 
-    # Step 1: Find pending donation by checkout_request_id
-    donations_ref = db.collection('donations')
-    pending_donation = donations_ref.where('checkout_request_id', '==', checkout_request_id).limit(1).stream()
-
-    doc_found = False
-    for doc in pending_donation:
-        doc_found = True
-        # Step 2: Update donation to Paid
-        doc.reference.update({
-            "status": "Paid",
-            "mpesa_receipt_number": mpesa_data.get("MpesaReceiptNumber"),
-            "transaction_date": mpesa_data.get("TransactionDate"),
-            "amount": mpesa_data.get("Amount"),
-            "phone": mpesa_data.get("PhoneNumber"),
-            "updated_at": datetime.utcnow().isoformat()
-        })
-        print(f"Donation updated: {doc.id}")
-
-        # Step 3: Send SMS via Twilio
+    if checkout_request_id in _seen_callbacks:
+        return {"message": "Duplicate callback ignored"}
+
+    # Reserve the ID before awaiting so concurrent retries are ignored too
+    _seen_callbacks[checkout_request_id] = time.time()
+    if len(_seen_callbacks) > _SEEN_MAX:
+        _seen_callbacks.popitem(last=False)
+
+    # Step 1: Update the pending donation (document ID is the checkout_request_id)
+    paid_fields = {
+        "status": "Paid",
+        "mpesa_receipt_number": receipt,
+        "transaction_date": txn_date,
+        "amount": amount,
+        "phone": phone,
+        "updated_at": datetime.utcnow().isoformat()
+    }
+    try:
+        doc_ref = _get_db(request.app).collection('donations').document(checkout_request_id)
         try:
-            twilio_client.messages.create(
-                body=f"Thank you for donating KES {mpesa_data.get('Amount')} to Jogoo CBO! Receipt: {mpesa_data.get('MpesaReceiptNumber')}.",
-                from_=TWILIO_PHONE_NUMBER,
-                to=f"+{mpesa_data.get('PhoneNumber')}"
-            )
-            print("Twilio SMS sent successfully")
-        except Exception as e:
-            print("Failed to send Twilio SMS:", e)
-
-    if not doc_found:
-        print("No matching pending donation found.")
+            await asyncio.to_thread(doc_ref.update, paid_fields)
+        except NotFound:
+            queued_record = _queued.get(checkout_request_id)
+            if queued_record is not None:
+                # Pending record not committed yet; its queued write carries the payment
+                queued_record.update(paid_fields)
+                logger.info("donation_paid_while_queued id=%s", checkout_request_id)
+            else:
+                # Pending record was lost (e.g. worker restarted); keep the payment anyway
+                await asyncio.to_thread(doc_ref.set, paid_fields, merge=True)
+                logger.warning("donation_not_found id=%s, saved payment only", checkout_request_id)
+    except Exception:
+        _seen_callbacks.pop(checkout_request_id, None)
+        raise
+
+    logger.info("donation_updated id=%s receipt=%s", doc_ref.id, receipt)
+
+    # Step 2: Send SMS via Twilio once the callback has been acknowledged
+    background_tasks.add_task(_send_sms, _get_http(request.app), amount, phone, receipt)
 
     return {"message": "Callback received and donation updated successfully"}